@@ -23,6 +23,7 @@ from sqlalchemy.orm.exc import NoResultFound, ObjectDeletedError
 from sqlalchemy.inspection import inspect
 from sqlalchemy.sql.elements import BooleanClauseList
 from flask_classful import FlaskView, route
+from flask_sqlalchemy import Pagination
 from marshmallow import Schema, EXCLUDE, fields
 from marshmallow.validate import Length
 from marshmallow_sqlalchemy import ModelConverter
@@ -42,9 +43,11 @@ from faraday.server.models import (
 )
 from faraday.server.schemas import NullToBlankString
 from faraday.server.utils.database import (
+    get_approx_count,
     get_conflict_object,
     is_unique_constraint_violation,
     not_null_constraint_violation,
+    paginate_keyset,
 )
 from faraday.server.utils.filters import FlaskRestlessSchema
 from faraday.server.utils.search import search
@@ -554,8 +557,11 @@ class ListMixin:
         objects, pagination_metadata = self._paginate(query)
         if not isinstance(objects, list):
             objects = objects.limit(None).offset(0)
-        return self._envelope_list(self._dump(objects, kwargs, many=True, exclude=exclude),
-                                   pagination_metadata)
+        res = self._envelope_list(self._dump(objects, kwargs, many=True, exclude=exclude),
+                                  pagination_metadata)
+        if isinstance(pagination_metadata, KeysetPagination) and isinstance(res, dict):
+            res['next_cursor'] = pagination_metadata.next_cursor
+        return res
 
 
 class SortableMixin:
@@ -640,10 +646,69 @@ class SortableMixin:
             raise InvalidUsage(f"field {order_field} doesn't support sorting") from e
 
 
+class KeysetPagination:
+    """Pagination metadata returned by PaginatedMixin when a cursor is used.
+
+    next_cursor is the value the client must send to get the next page, or
+    None if this is the last one.
+    """
+
+    def __init__(self, items, total, next_cursor):
+        self.items = items
+        self.total = total
+        self.next_cursor = next_cursor
+
+
 class PaginatedMixin:
-    """Add pagination for list route"""
+    """Add pagination for list route
+
+    If the cursor parameter is sent along with page_size, keyset pagination
+    over cursor_field (the primary key by default) is used instead of
+    OFFSET based pagination. The cursor to get the next page is returned
+    in the next_cursor key of the response. Keyset pages are always
+    ordered by cursor_field, so the cursor can't be sent along with a sort
+    field and the default order_field of the view is ignored.
+
+    If exact_count is 0 the total count of objects is an estimation of the
+    database planner instead of the result of counting every object.
+    """
     per_page_parameter_name = 'page_size'
     page_number_parameter_name = 'page'
+    cursor_parameter_name = 'cursor'
+    exact_count_parameter_name = 'exact_count'
+    #: Indexed, unique and monotonic integer column used for keyset
+    #: pagination. Defaults to the id of model_class
+    cursor_field = None
+
+    def _use_exact_count(self):
+        return flask.request.args.get(self.exact_count_parameter_name) != '0'
+
+    def _count(self, query):
+        if self._use_exact_count():
+            return query.order_by(None).count()
+        return get_approx_count(query)
+
+    def _paginate_keyset(self, query, per_page):
+        cursor_field = self.cursor_field if self.cursor_field is not None else self.model_class.id
+        sort_field_parameter_name = getattr(self, 'sort_field_parameter_name', None)
+        if sort_field_parameter_name in flask.request.args:
+            raise InvalidUsage(f"Can't sort by {sort_field_parameter_name} when using {self.cursor_parameter_name}, "
+                               f"pages are sorted by {cursor_field.key}")
+        cursor = flask.request.args[self.cursor_parameter_name]
+        try:
+            last_value = int(cursor) if cursor else None
+        except (TypeError, ValueError):
+            flask.abort(404, 'Invalid cursor value')
+        try:
+            keyset_query = paginate_keyset(query, cursor_field, last_value, per_page)
+        except ValueError:
+            flask.abort(404, 'Invalid per_page value')
+        total = self._count(query)
+        items = keyset_query.all()
+        next_cursor = None
+        if items and len(items) == per_page:
+            next_cursor = getattr(items[-1], cursor_field.key)
+        return items, KeysetPagination(items, total, next_cursor)
 
     def _paginate(self, query):
         page, per_page = None, None
@@ -661,7 +726,17 @@ class PaginatedMixin:
             except (TypeError, ValueError):
                 flask.abort(404, 'Invalid per_page value')
 
-            pagination_metadata = query.paginate(page=page, per_page=per_page, error_out=False)
+            if self.cursor_parameter_name in flask.request.args:
+                return self._paginate_keyset(query, per_page)
+
+            if self._use_exact_count():
+                pagination_metadata = query.paginate(page=page, per_page=per_page, error_out=False)
+            else:
+                # Same defaults as flask_sqlalchemy paginate with error_out=False
+                page = max(page, 1)
+                per_page = per_page if per_page >= 0 else 20
+                items = query.limit(per_page).offset((page - 1) * per_page).all()
+                pagination_metadata = Pagination(query, page, per_page, self._count(query), items)
             return pagination_metadata.items, pagination_metadata
         return super()._paginate(query)
 
@@ -62,6 +62,8 @@ from faraday.server.models import (
 from faraday.server.utils.cwe import get_or_create_cwe
 from faraday.server.utils.database import (
     get_conflict_object,
+    get_conflict_objects_bulk,
+    has_conflict,
     is_unique_constraint_violation,
     get_object_type_for,
 )
@@ -236,11 +238,15 @@ class BulkCreateSchema(Schema):
     execution_id = fields.Integer(attribute='execution_id')
 
 
-def get_or_create(ws: Workspace, model_class: Type[Metadata], data: dict):
+def get_or_create(ws: Workspace, model_class: Type[Metadata], data: dict, load_conflict: bool = True):
     """Check for conflicts and create a new object
 
     Is is passed the data parsed by the marshmallow schema (it
     transform from raw post data to a JSON)
+
+    If load_conflict is False and the object already exists, it only
+    checks that the conflicting object exists and returns None instead
+    of loading it.
     """
     nested = db.session.begin_nested()
     try:
@@ -252,6 +258,10 @@ def get_or_create(ws: Workspace, model_class: Type[Metadata], data: dict):
         if not is_unique_constraint_violation(ex):
             raise
         nested.rollback()
+        if not load_conflict:
+            if has_conflict(db.session, obj, data, ws):
+                return False, None
+            raise
         conflict_obj = get_conflict_object(db.session, obj, data, ws)
         if conflict_obj:
             return False, conflict_obj
@@ -343,8 +353,16 @@ def _create_host(ws, host_data, command: dict):
     total_services = len(_services)
     if total_services > 0:
         logger.debug(f"Needs to create {total_services} services...")
-        for service_data in _services:
-            _result = _create_service(ws, host, service_data, command)
+        # Find the services that already exist with one query instead of
+        # trying to insert each one of them
+        existing_services = get_conflict_objects_bulk(
+            db.session,
+            [Service() for _ in _services],
+            [dict(service_data, host=host) for service_data in _services],
+            ws
+        )
+        for service_data, existing_service in zip(_services, existing_services):
+            _result = _create_service(ws, host, service_data, command, existing_service)
             created_updated_count['created'] += _result['created']
             created_updated_count['updated'] += _result['updated']
 
@@ -552,7 +570,7 @@ def _create_command_object_for(ws, created, obj, command: dict):
         'created_persistent': created,
         'workspace': ws,
     }
-    get_or_create(ws, CommandObject, data)
+    get_or_create(ws, CommandObject, data, load_conflict=False)
     db.session.commit()
 
 
@@ -587,14 +605,17 @@ def _update_service(service: Service, service_data: dict) -> Service:
     return service
 
 
-def _create_service(ws, host, service_data, command: dict):
+def _create_service(ws, host, service_data, command: dict, existing_service: Service = None):
     service_data = service_data.copy()
     _vulns = service_data.pop('vulnerabilities', [])
     creds = service_data.pop('credentials', [])
     service_data['host'] = host
     created_updated_count = {'created': 0, 'updated': 0}
 
-    created, service = get_or_create(ws, Service, service_data)
+    if existing_service is not None:
+        created, service = False, existing_service
+    else:
+        created, service = get_or_create(ws, Service, service_data)
 
     if not created:
         service = _update_service(service, service_data)
@@ -60,6 +60,7 @@ from faraday.server.models import (
     User,
     Role,
 )
+from faraday.server.utils.database import init_dialect
 from faraday.server.utils.ping import ping_home_background_task
 
 from faraday.server.utils.reports_processor import reports_manager_background_task
@@ -484,6 +485,7 @@ def create_app(db_connection_string=None, testing=None, register_extensions_flag
 
     from faraday.server.models import db  # pylint:disable=import-outside-toplevel
     db.init_app(app)
+    init_dialect(app)
     # Session(app)
 
     # Setup Flask-Security
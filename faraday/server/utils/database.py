@@ -4,12 +4,16 @@ Copyright (C) 2016  Infobyte LLC (https://faradaysec.com/)
 See the file 'doc/LICENSE' for the license information
 """
 # Standard library imports
-import operator
-from functools import reduce
-
-from sqlalchemy import distinct, Boolean
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.ext import compiler
+import warnings
+from collections import defaultdict
+from functools import lru_cache
+
+from sqlalchemy import and_, distinct, Boolean, bindparam, literal, literal_column, tuple_, UniqueConstraint
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext import baked, compiler
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import make_transient_to_detached, scoped_session, selectinload
 from sqlalchemy.sql import func, asc, desc
 from sqlalchemy.sql.expression import ClauseElement, FunctionElement
 
@@ -19,13 +23,40 @@ class ORDER_DIRECTIONS:
     DESCENDING = 'desc'
 
 
+# Offsets above this value make the database scan and discard too many rows,
+# callers should move to paginate_keyset
+OFFSET_DEPRECATION_THRESHOLD = 10_000
+
+
 def paginate(query, page, page_size):
     """
     Limit results from a query based on pagination parameters
     """
     if not (page >= 0 and page_size >= 0):
         raise ValueError(f"Invalid values for pagination (page: {page}, page_size: {page_size})")
-    return query.limit(page_size).offset(page * page_size)
+    offset = page * page_size
+    if offset > OFFSET_DEPRECATION_THRESHOLD:
+        warnings.warn(f"OFFSET pagination is slow on deep pages (offset: {offset}), "
+                      f"use paginate_keyset instead", DeprecationWarning, stacklevel=2)
+    return query.limit(page_size).offset(offset)
+
+
+def paginate_keyset(query, sort_column, last_value, page_size):
+    """
+    Limit results from a query using keyset (cursor) pagination.
+
+    Returns the rows whose sort_column is greater than last_value, which
+    is the value of sort_column for the last row of the previous page (or
+    None to get the first page). sort_column must be indexed and unique
+    and monotonic (e.g. the primary key) so the database can seek straight
+    to the page instead of scanning all the previous ones like OFFSET does.
+    Any previous ordering of query is replaced by sort_column.
+    """
+    if not page_size >= 0:
+        raise ValueError(f"Invalid value for pagination (page_size: {page_size})")
+    if last_value is not None:
+        query = query.filter(sort_column > last_value)
+    return query.order_by(None).order_by(sort_column).limit(page_size)
 
 
 def sort_results(query, field_to_col_map, order_field, order_dir, default=None):
@@ -64,20 +95,19 @@ def apply_search_filter(query, field_to_col_map, free_text_search=None, field_fi
 
     # Iterate over every searchable field declared in the mapping
     # to then apply a filter on the query if required
-    for attribute in field_to_col_map:
-        is_direct_filter_search = attribute in field_filter
+    for attribute, columns in field_to_col_map.items():
+        field_search_term = field_filter.get(attribute)
+        is_direct_filter_search = field_search_term is not None
         is_free_text_search = not is_direct_filter_search and free_text_search
 
-        # Add wildcards to both ends of a search term
-        if is_direct_filter_search:
-            like_str = '%' + field_filter.get(attribute) + '%'
-        elif is_free_text_search:
-            like_str = '%' + free_text_search + '%'
-        else:
+        if is_free_text_search:
+            field_search_term = free_text_search
+        elif not is_direct_filter_search:
             continue
+        is_strict_filter = is_direct_filter_search and attribute in strict_filter
 
         search_term_sql_filter = None
-        for column in field_to_col_map.get(attribute):
+        for column in columns:
             # Labels are expressed as strings in the mapping,
             # currently we are not supporting searches on this
             # kind of fields since they are usually referred to
@@ -88,9 +118,12 @@ def apply_search_filter(query, field_to_col_map, free_text_search=None, field_fi
             # Prepare a SQL search term according to the columns type.
             # As default we treat every column as an string and therefore
             # we use 'like' to search through them.
-            if is_direct_filter_search and isinstance(column.type, Boolean):
-                field_search_term = field_filter.get(attribute).lower()
-                search_term = prepare_boolean_filter(column, field_search_term)
+            if isinstance(column.type, Boolean):
+                # Booleans can't be compared with LIKE, so the free text
+                # search skips them
+                if not is_direct_filter_search:
+                    continue
+                search_term = prepare_boolean_filter(column, field_search_term.lower())
                 # Ignore filter for this field if the values weren't expected
                 if search_term is None:
                     continue
@@ -98,17 +131,19 @@ def apply_search_filter(query, field_to_col_map, free_text_search=None, field_fi
                 # Strict filtering can be applied for fields. FTS will
                 # ignore this list since its purpose is clearly to
                 # match anything it can find.
-                if is_direct_filter_search and attribute in strict_filter:
-                    search_term = column.op('=')(field_filter.get(attribute))
+                if is_strict_filter:
+                    search_term = column.op('=')(field_search_term)
                 else:
-                    search_term = column.like(like_str)
+                    # The wildcards are added by the database and the ones in
+                    # the search term are escaped
+                    search_term = column.contains(field_search_term, autoescape=True)
 
             search_term_sql_filter = concat_or_search_term(search_term_sql_filter, search_term)
 
         # Concatenate multiple search terms on its proper filter
         if is_direct_filter_search:
             dfs_sql_filter = concat_and_search_term(dfs_sql_filter, search_term_sql_filter)
-        elif is_free_text_search:
+        else:
             fts_sql_filter = concat_or_search_term(fts_sql_filter, search_term_sql_filter)
 
     sql_filter = concat_and_search_term(fts_sql_filter, dfs_sql_filter)
@@ -165,18 +200,99 @@ def get_count(query, count_col=None):
     return count
 
 
-def get_or_create(session, model, defaults=None, **kwargs):
+def get_dialect_name(query):
+    return query.session.get_bind().dialect.name
+
+
+def get_approx_count(query):
+    """
+    Get an estimation of a query row's count from the PostgreSQL planner,
+    which avoids scanning every matching row like get_count does. Use it
+    only when an approximate total is enough (e.g. to show the number of
+    pages). Falls back to an exact count on other databases.
+    """
+    if get_dialect_name(query) != 'postgresql':
+        # get_count would count the rows added by joined eager loads too
+        return query.order_by(None).count()
+    connection = query.session.connection()
+    statement = query.enable_eagerloads(False).order_by(None).statement
+    compiled = statement.compile(dialect=connection.dialect)
+    plan = connection.execute(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_or_create(session, model, defaults=None, index_elements=None, **kwargs):
+    """
+    Get the instance of model matching kwargs or create it (without flushing)
+    if there is none. Returns a tuple (instance, created).
+
+    On PostgreSQL, if index_elements (the columns of a unique constraint
+    covering kwargs) is given and every value maps to a column of model, it
+    is done in a single INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+    statement instead, so there is no race between the SELECT and the
+    INSERT.
+    """
+    params = {k: v for k, v in kwargs.items() if not isinstance(v, ClauseElement)}
+    params.update(defaults or {})
+    if index_elements and len(params) == len(kwargs) + len(defaults or {}) and \
+            _can_upsert(session, model, params, index_elements):
+        return _upsert(session, model, params, index_elements)
     instance = session.query(model).filter_by(**kwargs).first()
     if instance:
         return instance, False
     else:
-        params = {k: v for k, v in kwargs.items() if not isinstance(v, ClauseElement)}
-        params.update(defaults or {})
         instance = model(**params)
         session.add(instance)
         return instance, True
 
 
+def _can_upsert(session, model, params, index_elements):
+    if session.get_bind().dialect.name != 'postgresql':
+        return False
+    mapper = inspect(model)
+    if mapper.inherits is not None or mapper.polymorphic_on is not None:
+        return False
+    return all(key in mapper.columns for key in params) and \
+        all(params.get(column) is not None for column in index_elements)
+
+
+def _upsert(session, model, params, index_elements):
+    """
+    Insert the row of model with params, or get the existing one if it
+    conflicts with the index_elements unique constraint, in one statement.
+    Returns a tuple (instance, created) like get_or_create.
+
+    The conflict sets a column of the constraint to the value it already
+    has, so the existing row isn't changed but RETURNING still returns it.
+    xmax is 0 only for the rows inserted by the statement.
+    """
+    mapper = inspect(model)
+    table = mapper.local_table
+    stmt = postgresql.insert(table).\
+        values({mapper.columns[key]: value for key, value in params.items()})
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={index_elements[0]: stmt.excluded[index_elements[0]]}
+    ).returning(*table.columns, literal_column('xmax = 0', type_=Boolean).label('inserted'))
+    if session.autoflush:
+        session.flush()
+    row = session.execute(stmt).first()
+
+    identity_key = mapper.identity_key_from_primary_key([row[column] for column in mapper.primary_key])
+    instance = session.identity_map.get(identity_key)
+    if instance is None:
+        # Build the instance from the returned row so it is added to the
+        # session as persistent without querying it again
+        instance = mapper.class_manager.new_instance()
+        for prop in mapper.column_attrs:
+            column = prop.columns[0]
+            if column.table is table:
+                setattr(instance, prop.key, row[column])
+        make_transient_to_detached(instance)
+        session.add(instance)
+    return instance, row['inserted']
+
+
 class GroupConcat(FunctionElement):
     name = "group_concat"
 
@@ -221,45 +337,115 @@ def get_object_type_for(instance):
     return object_type
 
 
+# Vulnerability unique index is an expression index, so it isn't declared as
+# a constraint in the model. If the unique index changes we need to update here.
+# A test should fail when the unique index changes
+_VULN_UNIQUE_CONSTRAINTS = [
+    {
+        'column_names': [
+            'name',
+            'description',
+            'type',
+            'host_id',
+            'service_id',
+            'method',
+            'parameter_name',
+            'path',
+            'website',
+            'workspace_id',
+        ]
+    }
+]
+
+
+@lru_cache(maxsize=None)
+def _get_model_unique_constraints(table):
+    """
+    Get the unique constraints declared in the model of a table, sorted by
+    the position of their columns in the table so the order is stable.
+    The models define the schema, so there is no need to reflect it from
+    the database catalog.
+    """
+    column_positions = {column.name: position for position, column in enumerate(table.columns)}
+    unique_constraints = [
+        [column.name for column in constraint.columns]
+        for constraint in table.constraints
+        if isinstance(constraint, UniqueConstraint)
+    ]
+    unique_constraints.sort(key=lambda column_names: [column_positions[name] for name in column_names])
+    return [{'column_names': column_names} for column_names in unique_constraints]
+
+
 def get_unique_fields(session, instance):
     table_name = get_object_type_for(instance)
     if table_name != 'vulnerability':
-        engine = session.connection().engine
-        insp = Inspector.from_engine(engine)
-        unique_constraints = insp.get_unique_constraints(table_name)
+        unique_constraints = _get_model_unique_constraints(instance.__table__)
     else:
-        # Vulnerability unique index can't be retrieved via reflection.
-        # If the unique index changes we need to update here.
-        # A test should fail when the unique index changes
-        unique_constraints = []
-        unique_constraints.append({
-            'column_names': [
-                'name',
-                'description',
-                'type',
-                'host_id',
-                'service_id',
-                'method',
-                'parameter_name',
-                'path',
-                'website',
-                'workspace_id',
-            ]
-        })
+        unique_constraints = _VULN_UNIQUE_CONSTRAINTS
     if unique_constraints:
         for unique_constraint in unique_constraints:
             yield unique_constraint['column_names']
 
 
-def get_conflict_object(session, obj, data, workspace=None):
+_conflict_bakery = baked.bakery()
+
+
+def _get_conflict_criteria(table, filter_keys):
+    return and_(*[table.columns[key] == bindparam(key) for key in filter_keys])
+
+
+def _get_conflict_query(klass, filter_keys, options=()):
+    """
+    Build a baked query filtering klass by equality on every column in
+    filter_keys. The values are sent as bind parameters, so the compiled
+    SQL is cached and reused for every (klass, filter_keys, options)
+    combination.
+    """
+    table = klass.__table__
+    conflict_query = _conflict_bakery(lambda session: session.query(klass), klass)
+    conflict_query.add_criteria(
+        lambda query: query.filter(_get_conflict_criteria(table, filter_keys)),
+        filter_keys)
+    if options:
+        conflict_query.add_criteria(lambda query: query.options(*options), options)
+    return conflict_query
+
+
+@lru_cache(maxsize=None)
+def _get_default_conflict_options(klass):
+    """
+    Loader options for the relationships usually accessed after getting a
+    conflict object (e.g. to dump it in the 409 response), so they are
+    loaded with one query each instead of lazily.
+    """
+    from faraday.server.models import VulnerabilityGeneric  # pylint:disable=import-outside-toplevel
+    if klass is VulnerabilityGeneric:
+        return (
+            selectinload(VulnerabilityGeneric.cve_instances),
+            selectinload(VulnerabilityGeneric.refs),
+        )
+    return ()
+
+
+@lru_cache(maxsize=None)
+def _split_unique_fields(unique_fields):
+    """
+    Split a tuple of unique fields into the plain fields and the relations
+    fields (the ones ending in _id)
+    """
+    fields = tuple(field for field in unique_fields if not field.endswith('_id'))
+    relations_fields = tuple(field for field in unique_fields if field.endswith('_id'))
+    return fields, relations_fields
+
+
+def _get_conflict_filter(session, obj, data, workspace=None):
+    """
+    Get the class to query and the {column_name: value} of its first unique
+    constraint that identify the object that conflicts with obj and data.
+    """
     unique_fields_gen = get_unique_fields(session, obj)
     for unique_fields in unique_fields_gen:
-        relations_fields = list(filter(
-            lambda unique_field: unique_field.endswith('_id'),
-            unique_fields))
-        unique_fields = list(filter(
-            lambda unique_field: not unique_field.endswith('_id'),
-            unique_fields))
+        unique_fields, relations_fields = _split_unique_fields(tuple(unique_fields))
 
         if get_object_type_for(obj) == 'vulnerability':
             # This is a special key due to model inheritance
@@ -271,7 +457,7 @@ def get_conflict_object(session, obj, data, workspace=None):
         table = klass.__table__
         assert (klass is not None and table is not None)
 
-        filter_data = []
+        filter_values = {}
         for unique_field in unique_fields:
             column = table.columns[unique_field]
             try:
@@ -281,36 +467,153 @@ def get_conflict_object(session, obj, data, workspace=None):
                 if not value and column.default:
                     value = column.default.arg
             if value:
-                filter_data.append(column == value)
+                filter_values[unique_field] = value
 
         if 'workspace_id' in relations_fields:
-            relations_fields.remove('workspace_id')
-            filter_data.append(table.columns['workspace_id'] == workspace.id)
+            filter_values['workspace_id'] = workspace.id
 
         for relations_field in relations_fields:
+            if relations_field == 'workspace_id':
+                continue
             if relations_field not in data and relations_field.strip('_id') in data:
                 related_object = data[relations_field.strip('_id')]
                 assert related_object.id is not None
-                filter_data.append(
-                    table.columns[relations_field] == related_object.id)
+                filter_values[relations_field] = related_object.id
             else:
                 relation_id = data.get(relations_field, None)
                 if relation_id:
-                    filter_data.append(
-                        table.columns[relations_field] == relation_id)
-        if filter_data:
-            filter_data = reduce(operator.and_, filter_data)
-            return session.query(klass).filter(filter_data).first()
-        else:
-            return
+                    filter_values[relations_field] = relation_id
+        return klass, filter_values
+    return None, {}
+
+
+def get_conflict_object(session, obj, data, workspace=None, options=None):
+    """
+    Get the object that conflicts with obj and data on its unique
+    constraint, or None if there is none.
+
+    options are loader options (e.g. selectinload) applied to the query,
+    the default ones depend on the class (see _get_default_conflict_options).
+    Reuse the same option objects between calls so the query is cached.
+    """
+    klass, filter_values = _get_conflict_filter(session, obj, data, workspace)
+    if filter_values:
+        if isinstance(session, scoped_session):
+            # Baked queries need the actual session, not the registry
+            session = session()
+        if options is None:
+            options = _get_default_conflict_options(klass)
+        conflict_query = _get_conflict_query(klass, tuple(sorted(filter_values)), tuple(options))
+        return conflict_query(session).params(**filter_values).first()
+    else:
+        return
+
+
+def has_conflict(session, obj, data, workspace=None):
+    """
+    Check if there is an object that conflicts with obj and data, like
+    get_conflict_object does, but with a SELECT 1 ... LIMIT 1 that doesn't
+    load the object. Use it when the conflict object itself isn't needed.
+    """
+    klass, filter_values = _get_conflict_filter(session, obj, data, workspace)
+    if not filter_values:
+        return False
+    if isinstance(session, scoped_session):
+        # Baked queries need the actual session, not the registry
+        session = session()
+    table = klass.__table__
+    filter_keys = tuple(sorted(filter_values))
+    exists_query = _conflict_bakery(lambda session: session.query(literal(1)).select_from(table), table)
+    exists_query.add_criteria(
+        lambda query: query.filter(_get_conflict_criteria(table, filter_keys)).limit(1),
+        filter_keys)
+    return exists_query(session).params(**filter_values).scalar() is not None
+
+
+# Max number of objects looked up by each query of get_conflict_objects_bulk,
+# to keep the number of bound parameters under the database limits
+CONFLICT_BULK_CHUNK_SIZE = 500
+
+
+def _coerce_conflict_value(column, value):
+    """
+    Convert value to the python type of column, which is the type of the
+    values returned by the database (e.g. port '80' to 80). Otherwise the
+    rows returned by get_conflict_objects_bulk wouldn't match the data.
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type in (int, float, str) and not isinstance(value, python_type):
+        try:
+            return python_type(value)
+        except (TypeError, ValueError):
+            return value
+    return value
+
+
+def get_conflict_objects_bulk(session, objs, data_list, workspace=None):
+    """
+    Same as get_conflict_object for many objects at once. Returns a list
+    with the conflicting object (or None) of each (obj, data) pair.
+
+    Instead of one query per object it issues one query per class and set
+    of filtered columns, matching all the objects with
+    (col1, col2, ...) IN ((...), (...), ...).
+    """
+    conflicts = [None] * len(objs)
+    groups = defaultdict(list)
+    for index, (obj, data) in enumerate(zip(objs, data_list)):
+        klass, filter_values = _get_conflict_filter(session, obj, data, workspace)
+        if filter_values:
+            filter_keys = tuple(sorted(filter_values))
+            key = tuple(_coerce_conflict_value(klass.__table__.columns[filter_key], filter_values[filter_key])
+                        for filter_key in filter_keys)
+            groups[(klass, filter_keys)].append((index, key))
+
+    for (klass, filter_keys), entries in groups.items():
+        columns = [klass.__table__.columns[filter_key] for filter_key in filter_keys]
+        keys = list({key for _, key in entries})
+        matches = {}
+        for chunk_start in range(0, len(keys), CONFLICT_BULK_CHUNK_SIZE):
+            chunk = keys[chunk_start:chunk_start + CONFLICT_BULK_CHUNK_SIZE]
+            rows = session.query(klass, *columns).filter(tuple_(*columns).in_(chunk))
+            for row in rows:
+                matches.setdefault(tuple(row[1:]), row[0])
+        for index, key in entries:
+            conflicts[index] = matches.get(key)
+    return conflicts
+
+
+# Whether the app database is PostgreSQL, set by init_dialect
+_IS_POSTGRES = None
+
+
+def init_dialect(app):
+    """
+    Cache whether the app database is PostgreSQL so the checks below don't
+    have to get the dialect from the engine on every call
+    """
+    global _IS_POSTGRES  # pylint:disable=global-statement
+    connection_string = app.config.get('SQLALCHEMY_DATABASE_URI')
+    # The dialect name, since postgres:// URIs have 'postgres' as backend name
+    _IS_POSTGRES = make_url(connection_string).get_dialect().name == 'postgresql' if connection_string else None
+
+
+def _is_postgres():
+    if _IS_POSTGRES is None:
+        # init_dialect wasn't called, fallback to the engine
+        from faraday.server.models import db  # pylint:disable=import-outside-toplevel
+        return db.engine.dialect.name == 'postgresql'
+    return _IS_POSTGRES
 
 
 UNIQUE_VIOLATION = '23505'
 
 
 def is_unique_constraint_violation(exception):
-    from faraday.server.models import db  # pylint:disable=import-outside-toplevel
-    if db.engine.dialect.name != 'postgresql':
+    if not _is_postgres():
         # Not implemented for RDMS other than postgres, we can live without
         # this since it is just an extra check
         return True
@@ -322,8 +625,7 @@ NOT_NULL_VIOLATION = '23502'
 
 
 def not_null_constraint_violation(exception):
-    from faraday.server.models import db  # pylint:disable=import-outside-toplevel
-    if db.engine.dialect.name != 'postgresql':
+    if not _is_postgres():
         # Not implemented for RDMS other than postgres, we can live without
         # this since it is just an extra check
         return True
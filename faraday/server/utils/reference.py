@@ -12,6 +12,7 @@ def create_reference(reference_list: list = [], vulnerability_id=None) -> list:
     for reference in reference_list:
         reference_obj, _ = get_or_create(db.session, VulnerabilityReference, name=reference['name'],
                                          vulnerability_id=vulnerability_id,
-                                         type=reference['type'])
+                                         type=reference['type'],
+                                         index_elements=['name', 'type', 'vulnerability_id'])
         reference_obj_set.add(reference_obj)
     return list(reference_obj_set)
@@ -402,6 +402,39 @@ def test_create_host_with_services(session, workspace):
     assert service.port == 80
 
 
+def test_create_host_with_existing_services(session, service, monkeypatch):
+    session.add(service)
+    session.commit()
+    host = service.host
+    existing_service_data = dict(service_data, name=f"{service.name}_changed",
+                                 port=service.port, protocol=service.protocol)
+    new_service_data = dict(service_data, port=service.port + 1)
+    host_data_copy = {
+        "ip": host.ip,
+        "description": host.description,
+        "services": [existing_service_data, new_service_data],
+    }
+    command = new_empty_command(service.workspace)
+    db.session.add(command)
+    db.session.commit()
+    command_dict = {'id': command.id, 'tool': command.tool, 'user': command.user}
+
+    created_services = []
+    original_get_or_create = bc.get_or_create
+
+    def get_or_create(ws, model_class, data, load_conflict=True):
+        if model_class is Service:
+            created_services.append(data['port'])
+        return original_get_or_create(ws, model_class, data, load_conflict)
+
+    monkeypatch.setattr(bc, 'get_or_create', get_or_create)
+    bc._create_host(service.workspace, host_data_copy, command_dict)
+    # The existing service is found without trying to insert it
+    assert created_services == [service.port + 1]
+    assert count(Service, service.workspace) == 2
+    assert service.name == existing_service_data['name']
+
+
 def test_create_existing_service(session, service):
     session.add(service)
     session.commit()
@@ -932,6 +932,18 @@ class TestHostAPIGeneric(ReadWriteAPITests, PaginationTestsMixin, BulkUpdateTest
     patchable_fields = update_fields
     view_class = HostsView
 
+    @pytest.mark.usefixtures('pagination_test_logic', 'mock_envelope_list_with_count')
+    @pytest.mark.pagination
+    def test_approximate_count_ignores_joined_hostnames(self, test_client, session, hostname_factory):
+        for host in self.create_many_objects(session, 3):
+            hostname_factory.create_batch(3, host=host, workspace=host.workspace)
+        session.commit()
+        self.analyze_table(session)
+        res = test_client.get(self.page_url(1, 2) + '&exact_count=0')
+        assert res.status_code == 200
+        assert len(res.json['data']) == 2
+        self.assert_approximate_count(session, res.json['count'], 3)
+
     @pytest.mark.usefixtures("mock_envelope_list")
     def test_sort_by_description(self, test_client, session):
         for host in Host.query.all():
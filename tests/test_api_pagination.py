@@ -33,6 +33,27 @@ class PaginationTestsMixin:
         # Load this two fixtures
         pass
 
+    @pytest.fixture
+    def mock_envelope_list_with_count(self, monkeypatch):
+        def _envelope_list(_, objects, pagination_metadata=None):
+            return {"data": objects, "count": pagination_metadata.total}
+
+        monkeypatch.setattr(self.view_class, '_envelope_list', _envelope_list)
+
+    def analyze_table(self, session):
+        # Approximate counts are estimated from the table statistics of
+        # PostgreSQL, update them after creating the objects
+        if session.bind.dialect.name == 'postgresql':
+            session.execute(f'ANALYZE {self.factory._meta.model.__table__.name}')
+
+    def assert_approximate_count(self, session, count, expected_count):
+        if session.bind.dialect.name == 'postgresql':
+            # The planner estimate isn't exact
+            assert 0 < count <= 2 * expected_count
+        else:
+            # Other databases fall back to the exact count
+            assert count == expected_count
+
     def create_many_objects(self, session, n):
         objects = self.factory.create_batch(n)
         session.commit()
@@ -109,3 +130,59 @@ class PaginationTestsMixin:
         res = test_client.get(self.page_url(1, 5))
         assert res.status_code == 200
         assert len(res.json['data']) == 0
+
+    def cursor_url(self, cursor, per_page):
+        parameters = {
+            self.view_class.cursor_parameter_name: cursor,
+            self.view_class.per_page_parameter_name: per_page,
+        }
+        return urljoin(self.url(), f'?{urlencode(parameters)}')
+
+    @pytest.mark.usefixtures('pagination_test_logic')
+    @pytest.mark.pagination
+    def test_pages_with_cursor_have_different_elements(self, session, test_client):
+        ids = {getattr(obj, self.pk_field)
+               for obj in self.create_many_objects(session, 25)}
+        cursor = ''
+        for page_number in range(1, 4):
+            res = test_client.get(self.cursor_url(cursor, 10))
+            assert res.status_code == 200
+            new_ids = [obj.get(self.pk_field) for obj in res.json['data']]
+            assert len(new_ids) == (5 if page_number == 3 else 10)
+            assert new_ids == sorted(new_ids)
+            assert set(new_ids).issubset(ids)
+            ids.difference_update(new_ids)
+            cursor = res.json['next_cursor']
+            if page_number == 3:
+                assert cursor is None
+            else:
+                assert cursor == new_ids[-1]
+        assert not ids
+
+    @pytest.mark.usefixtures('pagination_test_logic')
+    @pytest.mark.pagination
+    def test_cursor_cant_be_used_with_sort(self, session, test_client):
+        sort_field_parameter_name = getattr(self.view_class, 'sort_field_parameter_name', None)
+        if sort_field_parameter_name is None:
+            pytest.skip('The view is not sortable')
+        self.create_many_objects(session, 5)
+        url = self.cursor_url('', 2) + f'&{sort_field_parameter_name}={self.pk_field}'
+        res = test_client.get(url)
+        assert res.status_code == 400
+        assert self.view_class.cursor_parameter_name in res.json['message']
+
+    @pytest.mark.usefixtures('pagination_test_logic', 'mock_envelope_list_with_count')
+    @pytest.mark.pagination
+    def test_pages_with_approximate_count(self, session, test_client):
+        ids = {getattr(obj, self.pk_field)
+               for obj in self.create_many_objects(session, 15)}
+        self.analyze_table(session)
+        for page_number in range(1, 3):
+            url = self.page_url(page_number, 10) + '&exact_count=0'
+            res = test_client.get(url)
+            assert res.status_code == 200
+            new_ids = {obj.get(self.pk_field) for obj in res.json['data']}
+            assert len(new_ids) == (5 if page_number == 2 else 10)
+            self.assert_approximate_count(session, res.json['count'], 15)
+            ids.difference_update(new_ids)
+        assert not ids
@@ -6,13 +6,27 @@ See the file 'doc/LICENSE' for the license information
 '''
 
 import pytest
+from flask import Flask
 
-from faraday.server.utils.database import get_unique_fields
+from faraday.server.utils import database
+from faraday.server.utils.database import (
+    apply_search_filter,
+    get_conflict_object,
+    get_conflict_objects_bulk,
+    get_or_create,
+    get_unique_fields,
+    has_conflict,
+    init_dialect,
+    is_unique_constraint_violation,
+    not_null_constraint_violation,
+)
 from faraday.server.models import (
     License,
+    db,
     Service,
     Host,
     Vulnerability,
+    VulnerabilityReference,
     Workspace,
     vulnerability_uniqueness
 )
@@ -69,3 +83,162 @@ def test_unique_fields_workspace(obj_class, expected_unique_fields, session):
     unique_constraints = get_unique_fields(session, object_)
     for unique_constraint in unique_constraints:
         assert unique_constraint == expected_unique_fields
+
+
+def test_get_conflict_objects_bulk(session, workspace, host_factory):
+    hosts = host_factory.create_batch(2, workspace=workspace)
+    session.commit()
+    data_list = [{'ip': hosts[1].ip}, {'ip': 'not.a.conflict'}, {'ip': hosts[0].ip}]
+    objs = [Host() for _ in data_list]
+    conflicts = get_conflict_objects_bulk(session, objs, data_list, workspace)
+    assert conflicts == [hosts[1], None, hosts[0]]
+    assert conflicts == [get_conflict_object(session, obj, data, workspace)
+                         for obj, data in zip(objs, data_list)]
+
+
+def test_get_conflict_objects_bulk_coerces_values(session, workspace, service_factory):
+    service = service_factory.create(workspace=workspace, port=80, protocol='tcp')
+    session.commit()
+    data = {'port': '80', 'protocol': 'tcp', 'host': service.host}
+    assert get_conflict_object(session, Service(), data, workspace) == service
+    assert get_conflict_objects_bulk(session, [Service()], [data], workspace) == [service]
+
+
+def test_has_conflict(session, workspace, host_factory):
+    host = host_factory.create(workspace=workspace)
+    session.commit()
+    assert has_conflict(session, Host(), {'ip': host.ip}, workspace)
+    assert not has_conflict(session, Host(), {'ip': 'not.a.conflict'}, workspace)
+
+
+HOST_SEARCH_COLUMNS = {
+    'ip': [Host.ip],
+    'description': [Host.description],
+    'owned': [Host.owned],
+    'vulnerability_count': ['vulnerability_count'],
+}
+
+
+def search_hosts(session, **kwargs):
+    return set(apply_search_filter(session.query(Host), HOST_SEARCH_COLUMNS, **kwargs))
+
+
+def test_apply_search_filter(session, workspace, host_factory):
+    owned = host_factory.create(workspace=workspace, ip='10.0.0.1', description='web server', owned=True)
+    not_owned = host_factory.create(workspace=workspace, ip='10.0.0.12', description='mail server', owned=False)
+    session.commit()
+
+    assert search_hosts(session) == {owned, not_owned}
+    assert search_hosts(session, field_filter={'ip': '10.0.0.1'}) == {owned, not_owned}
+    assert search_hosts(session, field_filter={'ip': '10.0.0.1'}, strict_filter=['ip']) == {owned}
+    assert search_hosts(session, field_filter={'owned': 'True'}) == {owned}
+    assert search_hosts(session, field_filter={'owned': '0'}) == {not_owned}
+    # Unexpected boolean values are ignored
+    assert search_hosts(session, field_filter={'owned': 'maybe'}) == {owned, not_owned}
+    assert search_hosts(session, free_text_search='mail') == {not_owned}
+    assert search_hosts(session, free_text_search='server') == {owned, not_owned}
+    # The field filter takes precedence over the free text search
+    assert search_hosts(session, free_text_search='web', field_filter={'description': 'server'}) == set()
+    assert search_hosts(session, free_text_search='10.0', field_filter={'description': 'web'}) == {owned}
+    assert search_hosts(session, free_text_search='10.0', field_filter={'owned': 'false'}) == {not_owned}
+
+
+def test_apply_search_filter_escapes_wildcards(session, workspace, host_factory):
+    underscore = host_factory.create(workspace=workspace, description='web_server')
+    host_factory.create(workspace=workspace, description='webxserver')
+    percent = host_factory.create(workspace=workspace, description='100% owned')
+    session.commit()
+
+    assert search_hosts(session, field_filter={'description': 'b_s'}) == {underscore}
+    assert search_hosts(session, free_text_search='b_s') == {underscore}
+    assert search_hosts(session, free_text_search='0%') == {percent}
+    assert search_hosts(session, free_text_search='%') == {percent}
+
+
+def test_apply_search_filter_invalid_field(session):
+    with pytest.raises(ValueError):
+        apply_search_filter(session.query(Host), HOST_SEARCH_COLUMNS, field_filter={'os': 'linux'})
+
+
+REFERENCE_INDEX_ELEMENTS = ['name', 'type', 'vulnerability_id']
+
+
+def get_or_create_reference(session, vulnerability):
+    return get_or_create(session, VulnerabilityReference, name='http://example.com', type='other',
+                         vulnerability_id=vulnerability.id, index_elements=REFERENCE_INDEX_ELEMENTS)
+
+
+def assert_reference(reference, vulnerability):
+    assert reference.id is not None
+    assert reference.name == 'http://example.com'
+    assert reference.type == 'other'
+    assert reference.vulnerability_id == vulnerability.id
+
+
+@pytest.mark.skip_sql_dialect('sqlite')
+def test_get_or_create_upsert_new_row(session, vulnerability):
+    session.commit()
+    reference, created = get_or_create_reference(session, vulnerability)
+    assert created
+    assert reference in session
+    assert_reference(reference, vulnerability)
+    session.commit()
+    assert VulnerabilityReference.query.filter_by(vulnerability_id=vulnerability.id).one() is reference
+
+
+@pytest.mark.skip_sql_dialect('sqlite')
+def test_get_or_create_upsert_existing_row(session, vulnerability):
+    existing = VulnerabilityReference(name='http://example.com', type='other', vulnerability_id=vulnerability.id)
+    session.add(existing)
+    session.commit()
+    existing_id = existing.id
+    session.expunge(existing)
+
+    reference, created = get_or_create_reference(session, vulnerability)
+    assert not created
+    assert reference is not existing
+    assert reference in session
+    assert reference.id == existing_id
+    assert_reference(reference, vulnerability)
+    session.commit()
+    assert VulnerabilityReference.query.filter_by(vulnerability_id=vulnerability.id).one() is reference
+
+
+@pytest.mark.skip_sql_dialect('sqlite')
+def test_get_or_create_upsert_existing_row_in_identity_map(session, vulnerability):
+    existing = VulnerabilityReference(name='http://example.com', type='other', vulnerability_id=vulnerability.id)
+    session.add(existing)
+    session.commit()
+
+    reference, created = get_or_create_reference(session, vulnerability)
+    assert not created
+    assert reference is existing
+    assert_reference(reference, vulnerability)
+    session.commit()
+    assert VulnerabilityReference.query.filter_by(vulnerability_id=vulnerability.id).count() == 1
+
+
+@pytest.mark.parametrize('connection_string, is_postgres', [
+    ('postgres://faraday@localhost/faraday', True),
+    ('postgresql+psycopg2://faraday@localhost/faraday', True),
+    ('sqlite:///faraday.db', False),
+])
+def test_init_dialect(monkeypatch, connection_string, is_postgres):
+    monkeypatch.setattr(database, '_IS_POSTGRES', None)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = connection_string
+    init_dialect(app)
+    assert database._IS_POSTGRES is is_postgres
+    assert database._is_postgres() is is_postgres
+
+
+def test_is_postgres_falls_back_to_the_engine(monkeypatch, session):
+    monkeypatch.setattr(database, '_IS_POSTGRES', None)
+    assert database._is_postgres() is (db.engine.dialect.name == 'postgresql')
+
+
+def test_constraint_violations_not_checked_without_postgres(monkeypatch):
+    monkeypatch.setattr(database, '_IS_POSTGRES', False)
+    # The exception isn't inspected
+    assert is_unique_constraint_violation(None)
+    assert not_null_constraint_violation(None)